@@ -1,12 +1,16 @@
 import os
 import sys
-import time
 import logging
-import json
+import orjson
 import base64
 import binascii
 import math
+import struct
 import argparse
+import signal
+from collections import namedtuple
+from contextlib import nullcontext
+import numpy as np
 from waggle.plugin import Plugin
 from paho.mqtt.client import Client
 
@@ -27,7 +31,7 @@ class Config:
         parser.add_argument(
             "--parser_type",
             default=os.getenv("PARSER_TYPE", 'ChirpStack_v3+'),
-            help="Set the parser type (TheThingsStack_v3, ChirpStack_v3+)"
+            help="Set the parser type (%s)" % ", ".join(PARSERS)
         )
         parser.add_argument(
             "--mqtt-server-ip",
@@ -40,6 +44,13 @@ class Config:
             type=int,
             help="MQTT server port",
         )
+        parser.add_argument(
+            "--mqtt-qos",
+            default=os.getenv("MQTT_QOS", "0"),
+            type=int,
+            choices=[0, 1, 2],
+            help="MQTT QoS level for downlink messages (0, 1, 2). Defaults to 0; QoS 2 more than doubles publish latency and roughly doubles broker CPU",
+        )
         parser.add_argument(
             "--mqtt-subscribe-topic",
             default=None,
@@ -53,28 +64,35 @@ class Config:
         # Parse command-line arguments
         self._args = parser.parse_args()
 
+        # argparse only checks choices given on the command line, not the MQTT_QOS default
+        if self._args.mqtt_qos not in (0, 1, 2):
+            parser.error("argument --mqtt-qos: invalid choice: %d (choose from 0, 1, 2)" % self._args.mqtt_qos)
+
         #fail service if deveui is not passed
         if not self._args.device_devui:
             logging.error("[CONFIG] device-devui must be passed, see --help or plugin documentation")
             sys.exit(1)
         
+        # look up the parser entry (function, topic template, uplink and downlink topic suffixes)
+        if self._args.parser_type not in PARSERS:
+            logging.error("[CONFIG] Unknown parser type %s" % self._args.parser_type)
+            sys.exit(1)
+        (self._args.parser, topic_template, up_suffix, down_suffix) = PARSERS[self._args.parser_type]
+        self._args.topic_up_suffix_length = len(up_suffix)
+        self._args.topic_down_suffix = down_suffix
+
         # add auto-generated subscribe topic
         if not self._args.mqtt_subscribe_topic:
-            if self._args.parser_type == 'TheThingsStack_v3':
-                self._args.mqtt_subscribe_topic = f"v3/+/devices/{self._args.device_devui}/up"
-            elif self._args.parser_type == 'ChirpStack_v3+':
-                # chirpstack topic template is here https://www.chirpstack.io/docs/chirpstack/configuration.html in [integration.mqtt] section
-                # chirpstack template: application/{{application_id}}/device/{{dev_eui}}/event/{{event}}
-                self._args.mqtt_subscribe_topic = f"application/+/device/{self._args.device_devui}/event/up"
-            else:
-                logging.error("[CONFIG] Unknown parser type %s" % self._args.parser_type)
-                sys.exit(1)
+            self._args.mqtt_subscribe_topic = topic_template.format(devui=self._args.device_devui)
 
     def get(self, name, default=None):
         # Convert config key to argument format
         arg_name = name.replace('.', '_').replace('-', '_')
         return getattr(self._args, arg_name, default)
 
+# Snapshot of the settings read on every message, built once in main()
+RuntimeCfg = namedtuple('RuntimeCfg', ['publish', 'plugin', 'mqtt_qos', 'topic_up_suffix_length', 'topic_down_suffix'])
+
 class MQTTClient(Client):
 
     MQTTv31 = 3
@@ -105,138 +123,186 @@ class MQTTClient(Client):
         self.on_connect = connect_callback_default
         self.on_disconnect = disconnect_callback_default
         self.on_subscribe = subscribe_callback_default
+        # allow more QoS>0 downlinks in flight (paho default is 20)
+        self.max_inflight_messages_set(64)
         if username and password:
             self.username_pw_set(username, password)
         self.connect(broker, port)
 
-    def start(self):
-        self.loop_start()
-
-def publish(measurement: dict, timestamp = time.time(), metadata = {}):
-    if measurement["value"] is not None: #avoid NULLs
-        with Plugin() as plugin: #publish lorawan data
-            try:
-                plugin.publish(measurement["name"], measurement["value"], timestamp=timestamp, meta=metadata)
-                # If the function succeeds, log a success message
-                logging.info(f'[PUBLISH] {measurement["name"]} published')
-            except Exception as e:
-                # If an exception is raised, log an error message
-                logging.error(f'[PUBLISH] measurement {measurement["name"]} did not publish encountered an error: {str(e)}')
+    def run_forever(self):
+        # blocks the calling thread on the network loop until disconnect() is called
+        # the broker connection is already made in __init__, reconnects are handled by paho
+        self.loop_forever()
+
+def publish_many(plugin, measurements, timestamp=None, metadata=None):
+    for name, value in measurements:
+        if value is None: #avoid NULLs
+            continue
+        try:
+            plugin.publish(name, value, timestamp=timestamp, meta=metadata or {})
+            # If the function succeeds, log a success message
+            logging.info('[PUBLISH] %s published', name)
+        except Exception as e:
+            # If an exception is raised, log an error message
+            logging.error(f'[PUBLISH] measurement {name} did not publish encountered an error: {str(e)}')
 
 EARTH_RADIUS = 6371000
 
-def degreesToRadians(degrees):
-    return degrees * (math.pi / 180)
-
-def radiansToDegrees(radians):
-    return radians * (180 / math.pi)
-
-def angularDistance(location1, location2):
-    location1_latitude_radians = degreesToRadians(location1.get('latitude'))
-    location2_latitude_radians = degreesToRadians(location2.get('latitude'))
-    return math.acos(
-        math.sin(location1_latitude_radians) * math.sin(location2_latitude_radians) +
-        math.cos(location1_latitude_radians) * math.cos(location2_latitude_radians) * 
-            math.cos(degreesToRadians(abs(location1.get('longitude') - location2.get('longitude'))))
-    )
+def angularDistance(latitude, longitude, latitudes, longitudes):
+    # haversine formula, the payload latitude is converted once for all gateways
+    latitude_radians = math.radians(latitude)
+    latitudes_radians = np.radians(latitudes)
+    delta_latitudes = latitudes_radians - latitude_radians
+    delta_longitudes = np.radians(longitudes - longitude)
+    a = (np.sin(delta_latitudes / 2) ** 2 +
+        math.cos(latitude_radians) * np.cos(latitudes_radians) * np.sin(delta_longitudes / 2) ** 2)
+    return 2 * np.arcsin(np.sqrt(np.minimum(a, 1.0)))
 
-def circleDistance(location1, location2):
-    return EARTH_RADIUS * angularDistance(location1, location2);
+def circleDistance(latitude, longitude, latitudes, longitudes):
+    return EARTH_RADIUS * angularDistance(latitude, longitude, latitudes, longitudes)
 
-def constrain(value, lower, upper):
-    return min(upper, max(lower, value))
-
-MAX_DISTANCE=1e6
+MAX_DISTANCE=1000000
 MIN_DISTANCE=0
 MAX_RSSI=200
 MIN_RSSI=-200
-
-def process(data, port, sequence_id, gateways, config):
+RSSI_BIAS=200 # rssi is sent to the device shifted into an unsigned byte
+
+def unpack_gps(data):
+    # Decode the GPS fields packed in the first 10 bytes of the uplink payload
+    # returns (hdop, sats, has_gps, latitude, longitude, altitude, accuracy)
+    # without a GPS fix the position fields are NaN so every return has the same element types
+    hdop = data[8]/10
+    sats = data[9]
+    has_gps = (hdop <= 2) and (sats >= 5)
+    if not has_gps:
+        return (hdop, sats, False, math.nan, math.nan, math.nan, math.nan)
+
+    # bit 7 is the longitude sign and bit 6 the latitude sign, mapped to +1/-1
+    signs = data[0]>>6
+    latSign = 1 - ((signs & 0x01)<<1)
+    lonSign = 1 - (signs & 0x02)
+    encLat = ((data[0] & 0x3f)<<17) + (data[1]<<9) + (data[2]<<1) + (data[3]>>7)
+    encLon = ((data[3] & 0x7f)<<16) + (data[4]<<8) + data[5]
+    latitude = latSign * (encLat * 108 + 53) / 10000000
+    longitude = lonSign * (encLon * 215 + 107) / 10000000
+    altitude = float(((data[6]<<8) + data[7]) - 1000)
+    accuracy = (hdop * 5 + 5) / 10
+    return (hdop, sats, True, latitude, longitude, altitude, accuracy)
+
+def gateway_arrays(gateways):
+    # Convert the gateway metadata (list of dicts) into rssi, latitude and longitude arrays
+    # missing or null values become NaN
+    locations = [g.get('location') or {} for g in gateways]
+    rssis = np.array([g.get('rssi') for g in gateways], dtype=float)
+    lats = np.array([l.get('latitude') for l in locations], dtype=float)
+    lons = np.array([l.get('longitude') for l in locations], dtype=float)
+    return (rssis, lats, lons)
+
+def measure(data, port, sequence_id, rssis, lats, lons):
+    # Numeric core of the uplink processing: decode, aggregate gateways and build the response buffer
+    # no logging, publishing or MQTT here, the parsers log the returned output (including the buffer)
 
     output = {}
 
     # Gather data
-    output['hdop'] = data[8]/10
-    output['sats'] = data[9]
-    output['has_gps'] = (output['hdop'] <= 2) and (output['sats'] >= 5)
+    (hdop, sats, has_gps, latitude, longitude, altitude, accuracy) = unpack_gps(data)
+    output['hdop'] = hdop
+    output['sats'] = sats
+    output['has_gps'] = has_gps
     
     # We only add GPS data and distances information if there is valid GPS data
     if output['has_gps']:
-        lonSign = -1 if ((data[0]>>7) & 0x01) else 1
-        latSign = -1 if ((data[0]>>6) & 0x01) else 1
-        encLat = ((data[0] & 0x3f)<<17) + (data[1]<<9) + (data[2]<<1) + (data[3]>>7)
-        encLon = ((data[3] & 0x7f)<<16) + (data[4]<<8) + data[5]
-        output['latitude'] = latSign * (encLat * 108 + 53) / 10000000
-        output['longitude'] = lonSign * (encLon * 215 + 107) / 10000000
-        output['altitude'] = ((data[6]<<8) + data[7]) - 1000
-        output['accuracy'] = (output['hdop'] * 5 + 5) / 10
+        output['latitude'] = latitude
+        output['longitude'] = longitude
+        output['altitude'] = int(altitude)
+        output['accuracy'] = accuracy
 
     # Build gateway data
-    output['num_gateways'] = len(gateways)
+    output['num_gateways'] = len(rssis)
     output['min_distance'] = MAX_DISTANCE if output['has_gps'] else MIN_DISTANCE
     output['max_distance'] = MIN_DISTANCE
     output['min_rssi'] = MAX_RSSI
     output['max_rssi'] = MIN_RSSI
-    for gateway in gateways:
 
-        output['min_rssi'] = min(output['min_rssi'], gateway.get('rssi', MAX_RSSI))
-        output['max_rssi'] = max(output['max_rssi'], gateway.get('rssi', MIN_RSSI))
+    rssis = rssis[~np.isnan(rssis)]
+    if rssis.size:
+        output['min_rssi'] = int(np.min(rssis))
+        output['max_rssi'] = int(np.max(rssis))
 
-        if output['has_gps']:
-            loc = gateway.get('location', {})
-            lat = loc.get('latitude')
-            lon = loc.get('longitude')
-            if lat is not None and lon is not None:
-                distance = int(circleDistance(output, loc)) 
-                output['min_distance'] = min(output['min_distance'], distance)
-                output['max_distance'] = max(output['max_distance'], distance)
-
-    # Publish data to beehive
-    if config.get('publish'):
-        publish({'name': 'gps.hdop', 'value': output.get('hdop', None)})
-        publish({'name': 'gps.sats', 'value': output.get('sats', None)})
-        publish({'name': 'gps.latitude', 'value': output.get('latitude', None)})
-        publish({'name': 'gps.longitude', 'value': output.get('longitude', None)})
-        publish({'name': 'gps.altitude', 'value': output.get('altitude', None)})
-        publish({'name': 'gps.accuracy', 'value': output.get('accuracy', None)})
-        publish({'name': 'gateway.min_distance', 'value': output.get('min_distance', None)})
-        publish({'name': 'gateway.max_distance', 'value': output.get('max_distance', None)})
-        publish({'name': 'gateway.min_rssi', 'value': output.get('min_rssi', None)})
-        publish({'name': 'gateway.max_rssi', 'value': output.get('max_rssi', None)})
-        publish({'name': 'gateway.num_gateways', 'value': output.get('num_gateways', None)})
+    if output['has_gps']:
+        located = ~(np.isnan(lats) | np.isnan(lons))
+        if located.any():
+            distances = circleDistance(output['latitude'], output['longitude'], lats[located], lons[located])
+            output['min_distance'] = min(MAX_DISTANCE, int(distances.min()))
+            output['max_distance'] = int(distances.max())
 
     # Build response buffer
     if 1 == port:
-        min_distance = constrain(int(round(output['min_distance'] / 250.0)), 1, 128) if output['has_gps'] else 0
-        max_distance = constrain(int(round(output['max_distance'] / 250.0)), 1, 128) if output['has_gps'] else 0
-        output['buffer'] = [
-            sequence_id % 256,
-            int(output['min_rssi'] + 200) % 256,
-            int(output['max_rssi'] + 200) % 256,
+        # distances in 250m steps, rounded and clamped to 1..128
+        min_distance = max_distance = 0
+        if output['has_gps']:
+            min_distance = (output['min_distance'] + 125) // 250
+            min_distance = 1 if min_distance < 1 else 128 if min_distance > 128 else min_distance
+            max_distance = (output['max_distance'] + 125) // 250
+            max_distance = 1 if max_distance < 1 else 128 if max_distance > 128 else max_distance
+        output['buffer'] = struct.pack('>BBBBBB',
+            sequence_id & 0xff,
+            (output['min_rssi'] + RSSI_BIAS) & 0xff,
+            (output['max_rssi'] + RSSI_BIAS) & 0xff,
             min_distance,
             max_distance,
-            output['num_gateways'] % 256
-        ]
+            output['num_gateways'] & 0xff
+        )
     elif 11 == port:
-        min_distance = constrain(int(round(output['min_distance'] / 10.0)), 1, 65535) if output['has_gps'] else 0
-        max_distance = constrain(int(round(output['max_distance'] / 10.0)), 1, 65535) if output['has_gps'] else 0
-        logging.debug("[TTS3] max_distance: %d" % max_distance)
-        output['buffer'] = [
-            sequence_id % 256,
-            int(output['min_rssi'] + 200) % 256,
-            int(output['max_rssi'] + 200) % 256,
-            int(min_distance / 256) % 256, min_distance % 256,
-            int(max_distance / 256) % 256, max_distance % 256,
-            output['num_gateways'] % 256
-        ]
+        # distances in 10m steps, rounded and clamped to 1..65535
+        min_distance = max_distance = 0
+        if output['has_gps']:
+            min_distance = (output['min_distance'] + 5) // 10
+            min_distance = 1 if min_distance < 1 else 65535 if min_distance > 65535 else min_distance
+            max_distance = (output['max_distance'] + 5) // 10
+            max_distance = 1 if max_distance < 1 else 65535 if max_distance > 65535 else max_distance
+        output['buffer'] = struct.pack('>BBBHHB',
+            sequence_id & 0xff,
+            (output['min_rssi'] + RSSI_BIAS) & 0xff,
+            (output['max_rssi'] + RSSI_BIAS) & 0xff,
+            min_distance,
+            max_distance,
+            output['num_gateways'] & 0xff
+        )
+
+    return output
+
+def process(data, port, sequence_id, rssis, lats, lons, cfg):
+
+    output = measure(data, port, sequence_id, rssis, lats, lons)
+
+    # Publish data to beehive
+    if cfg.publish:
+        publish_many(cfg.plugin, [
+            ('gps.hdop', output.get('hdop', None)),
+            ('gps.sats', output.get('sats', None)),
+            ('gps.latitude', output.get('latitude', None)),
+            ('gps.longitude', output.get('longitude', None)),
+            ('gps.altitude', output.get('altitude', None)),
+            ('gps.accuracy', output.get('accuracy', None)),
+            ('gateway.min_distance', output.get('min_distance', None)),
+            ('gateway.max_distance', output.get('max_distance', None)),
+            ('gateway.min_rssi', output.get('min_rssi', None)),
+            ('gateway.max_rssi', output.get('max_rssi', None)),
+            ('gateway.num_gateways', output.get('num_gateways', None)),
+        ])
 
     return output
 
-def parser_tts3(config, topic, payload):
+def parser_tts3(cfg, topic, payload):
+
+    # Skip non uplink events without parsing them
+    if b'"uplink_message"' not in payload:
+        return [False, False]
 
     # Parse payload
     try:
-        payload = json.loads(payload)
+        payload = orjson.loads(payload)
     except:
         logging.error("[TTS3] Decoding message has failed")
         return [False, False]
@@ -252,43 +318,48 @@ def parser_tts3(config, topic, payload):
 
     # Get attributes
     sequence_id = payload['uplink_message']['f_cnt']
-    gateways = payload['uplink_message']['rx_metadata']
+    (rssis, lats, lons) = gateway_arrays(payload['uplink_message']['rx_metadata'])
     data = base64.b64decode((payload['uplink_message']['frm_payload']))
-    logging.debug("[TTS3] Received: 0x%s" % binascii.hexlify(data).decode('utf-8'))
+    if logging.getLogger().isEnabledFor(logging.DEBUG):
+        logging.debug("[TTS3] Received: 0x%s", binascii.hexlify(data).decode('utf-8'))
     
     # Process the data
-    data = process(data, port, sequence_id, gateways, config)
+    data = process(data, port, sequence_id, rssis, lats, lons, cfg)
     if not data:
         return [False, False]
-    logging.debug("[TTS3] Processed: %s" % data)
+    logging.debug("[TTS3] Processed: %s", data)
 
     # Get topic
-    topic = topic.replace('/up', '/down/replace')
+    topic = topic[:-cfg.topic_up_suffix_length] + cfg.topic_down_suffix
 
     # Build downlink
     downlink = {
         'downlinks': [{
             'f_port': port + 1,
-            'frm_payload': base64.b64encode(bytes(data['buffer'])).decode('utf-8'),
+            'frm_payload': base64.b64encode(data['buffer']).decode('utf-8'),
             'priority': 'HIGH'
         }]
     }
 
     # Return topic and payload
-    return [topic, json.dumps(downlink)]
+    return [topic, orjson.dumps(downlink)]
 
-def parser_cs34(config, topic, payload):
+def parser_cs34(cfg, topic, payload):
+
+    # Skip events without a port (join, ack, status...) without parsing them
+    if b'"fPort"' not in payload:
+        return [False, False]
 
     # Parse payload
     try:
-        payload = json.loads(payload)
+        payload = orjson.loads(payload)
     except:
         logging.error("[CS34] Decoding message has failed")
         return [False, False]
 
     # Chirpstack version
     version = 4 if 'deviceInfo' in payload else 3
-    logging.debug("[CS34] ChirpStack version %d payload" % version)
+    logging.debug("[CS34] ChirpStack version %d payload", version)
 
     # Get port
     port = payload.get('fPort', 0)
@@ -297,30 +368,39 @@ def parser_cs34(config, topic, payload):
 
     # Get attributes
     sequence_id = payload['fCnt']
-    gateways = payload['rxInfo']
+    (rssis, lats, lons) = gateway_arrays(payload['rxInfo'])
     data = base64.b64decode((payload['data']))
-    logging.debug("[CS34] Received: 0x%s" % binascii.hexlify(data).decode('utf-8'))
+    if logging.getLogger().isEnabledFor(logging.DEBUG):
+        logging.debug("[CS34] Received: 0x%s", binascii.hexlify(data).decode('utf-8'))
     
     # Process the data
-    data = process(data, port, sequence_id, gateways, config)
+    data = process(data, port, sequence_id, rssis, lats, lons, cfg)
     if not data:
         return [False, False]
-    logging.debug("[CS34] Processed: %s" % data)
+    logging.debug("[CS34] Processed: %s", data)
 
     # Get topic
-    topic = topic.replace('/event/up', '/command/down')
+    topic = topic[:-cfg.topic_up_suffix_length] + cfg.topic_down_suffix
 
     # Build downlink
     downlink = {    
         'confirmed': False,
         'fPort': port + 1,
-        'data': base64.b64encode(bytes(data['buffer'])).decode('utf-8')
+        'data': base64.b64encode(data['buffer']).decode('utf-8')
     }
     if version == 4:
         downlink['devEui'] = payload['deviceInfo']['devEui']
 
     # Return topic and payload
-    return [topic, json.dumps(downlink)]
+    return [topic, orjson.dumps(downlink)]
+
+# Supported network servers: (parser, subscribe topic template, uplink topic suffix, downlink topic suffix)
+PARSERS = {
+    'TheThingsStack_v3': (parser_tts3, 'v3/+/devices/{devui}/up', '/up', '/down/replace'),
+    # chirpstack topic template is here https://www.chirpstack.io/docs/chirpstack/configuration.html in [integration.mqtt] section
+    # chirpstack template: application/{{application_id}}/device/{{dev_eui}}/event/{{event}}
+    'ChirpStack_v3+': (parser_cs34, 'application/+/device/{devui}/event/up', '/event/up', '/command/down'),
+}
 
 def main():
 
@@ -333,38 +413,41 @@ def main():
     logging.debug("[MAIN] Setting logging level to %d" % level)
 
     # configure parser
-    parser = False
-    parser_type = config.get('parser.type')
-    if parser_type == 'TheThingsStack_v3':
-        parser = parser_tts3
-        logging.debug("[MAIN] Using The Things Stack v3 parser")
-    elif parser_type == 'ChirpStack_v3+':
-        parser = parser_cs34
-        logging.debug("[MAIN] Using ChirpStack v3+ parser")
-    else:
-        logging.debug("[MAIN] Unknown parser type %s" % parser_type)
-        sys.exit(1)
-
-    def mqtt_on_message(client, userdata, msg):
-        payload = msg.payload.decode('utf-8')
-        logging.debug("[MQTT] Received for %s" % msg.topic)
-        (topic, payload) = parser(config, msg.topic, payload)
-        if topic:
-            logging.debug("[MQTT] Topic: %s" % topic)
-            logging.debug("[MQTT] Payload: %s" % payload)
-            mqtt_client.publish(topic, payload)
-
-
-    mqtt_client = MQTTClient(
-        config.get('mqtt.server.ip'), 
-        int(config.get('mqtt.server.port'))
-    )
-    mqtt_client.on_message = mqtt_on_message
-    mqtt_client.subscribe(config.get('mqtt.subscribe.topic'))
-    mqtt_client.start()
-
-    while (True):
-        time.sleep(0.01) 
+    parser = config.get('parser')
+    logging.debug("[MAIN] Using %s parser" % config.get('parser.type'))
+
+    # open a single plugin context for the lifetime of the service, only needed in publish mode
+    with (Plugin() if config.get('publish') else nullcontext()) as plugin:
+
+        # settings used in the message hot path
+        cfg = RuntimeCfg(
+            publish=config.get('publish'),
+            plugin=plugin,
+            mqtt_qos=config.get('mqtt.qos'),
+            topic_up_suffix_length=config.get('topic.up.suffix.length'),
+            topic_down_suffix=config.get('topic.down.suffix')
+        )
+
+        def mqtt_on_message(client, userdata, msg):
+            logging.debug("[MQTT] Received for %s", msg.topic)
+            (topic, payload) = parser(cfg, msg.topic, msg.payload)
+            if topic:
+                logging.debug("[MQTT] Topic: %s", topic)
+                if logging.getLogger().isEnabledFor(logging.DEBUG):
+                    logging.debug("[MQTT] Payload: %s", payload.decode('utf-8'))
+                mqtt_client.publish(topic, payload, qos=cfg.mqtt_qos)
+
+
+        mqtt_client = MQTTClient(
+            config.get('mqtt.server.ip'), 
+            int(config.get('mqtt.server.port'))
+        )
+        mqtt_client.on_message = mqtt_on_message
+        mqtt_client.subscribe(config.get('mqtt.subscribe.topic'))
+
+        # on SIGTERM (container stop) disconnect so the MQTT loop returns and the plugin context flushes
+        signal.signal(signal.SIGTERM, lambda signum, frame: mqtt_client.disconnect())
+        mqtt_client.run_forever()
 
 if (__name__ == '__main__'): 
     main()
\ No newline at end of file